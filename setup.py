@@ -29,7 +29,7 @@ setuptools.setup(
         "Typing :: Typed",
     ],
     py_modules=["spotifython_cli"],
-    install_requires=["spotifython>=0.2.9", "click"],
+    install_requires=["spotifython>=0.2.9", "click", "requests"],
     python_requires=">=3.10",
-    entry_points={"console_scripts": ["spotifython-cli=spotifython_cli:cli"]},
+    entry_points={"console_scripts": ["spotifython-cli=spotifython_cli:main"]},
 )
@@ -1,16 +1,139 @@
-from collections.abc import Mapping
+from collections.abc import Mapping, Sequence
+import heapq
 import json
 import os
 import random
+import sqlite3
+import struct
+import sys
+import threading
 import time
 import re
 
 import spotifython
+import spotifython.connection
+import requests
 import click
 from click import shell_completion
 import configparser
 import logging
 
+API_URL = "https://api.spotify.com/"
+ACCOUNTS_URL = "https://accounts.spotify.com/"
+# commands (with subcommand) that send requests to the api
+API_COMMANDS = {
+    ("play",),
+    ("pause",),
+    ("play-pause",),
+    ("next",),
+    ("prev",),
+    ("device",),
+    ("metadata",),
+    ("refresh-snapshot",),
+    ("history", "record"),
+}
+
+
+class PrewarmedRequests:
+    # stands in for the requests module in spotifython.connection so all requests
+    # share one keep-alive session whose connections can be opened in advance
+    def __init__(self):
+        self._session = requests.Session()
+        self._threads: dict[str, threading.Thread] = {}
+        self._opened: dict[str, tuple] = {}
+
+    def connect(self, url: str):
+        # only the tcp and tls handshake in the background, no request
+        thread = threading.Thread(target=self._connect, args=(url,), daemon=True)
+        self._threads[url] = thread
+        thread.start()
+
+    def _connect(self, url: str):
+        settings = self._session.merge_environment_settings(url, {}, None, None, None)
+        adapter = self._session.get_adapter(url)
+        try:
+            pool = adapter.get_connection_with_tls_context(
+                requests.Request("GET", url).prepare(),
+                settings["verify"],
+                settings["proxies"],
+                settings["cert"],
+            )
+            adapter.cert_verify(pool, url, settings["verify"], settings["cert"])
+            conn = pool._get_conn()
+        except Exception as e:
+            logging.debug(f"could not open connection to {url} in advance: {e}")
+            return
+        try:
+            conn.connect()
+        except Exception as e:
+            logging.debug(f"could not open connection to {url} in advance: {e}")
+        self._opened[url] = (pool, conn)
+
+    @staticmethod
+    def _release(pool, conn):
+        # tls 1.3 session tickets arrive after the handshake; unread, they make
+        # urllib3 consider the idle connection dropped and open a new one
+        if (sock := conn.sock) is not None:
+            timeout = sock.gettimeout()
+            sock.setblocking(False)
+            try:
+                sock.recv(1)
+            except OSError:
+                # nothing to read; a broken connection is replaced by urllib3
+                pass
+            finally:
+                sock.settimeout(timeout)
+        # the session takes the connection from this pool for the next request
+        pool._put_conn(conn)
+
+    def __getattr__(self, name: str):
+        return getattr(requests, name)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        # waits for the rest of a handshake instead of opening a second connection
+        for base in [base for base in self._threads if url.startswith(base)]:
+            self._threads.pop(base).join()
+            if (opened := self._opened.pop(base, None)) is not None:
+                self._release(*opened)
+        return self._session.request(method, url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+
+def invoked_command(argv: list[str]) -> tuple[str, ...]:
+    # the leading words of the command line after the options of `cli`
+    words = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in ("-c", "--config", "--device-id"):
+            skip = True
+        elif not arg.startswith("-"):
+            words.append(arg)
+            if len(words) == 2:
+                break
+        elif len(words) > 0:
+            break
+    return tuple(words)
+
+
+def get_cache_dir() -> str:
+    return os.path.join(
+        os.getenv("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+        "spotifython-cli",
+    )
+
+
+def get_data_dir() -> str:
+    return os.path.join(
+        os.getenv(
+            "XDG_DATA_HOME", os.path.join(os.path.expanduser("~"), ".local", "share")
+        ),
+        "spotifython-cli",
+    )
+
 
 def load_authentication(
     cache_dir: str, config: configparser.ConfigParser
@@ -75,6 +198,357 @@ def dmenu_select(
     return [options[sel] for sel in selected if sel in options]
 
 
+class Selection:
+    # parallel lists instead of spotifython elements; a name of None is unknown
+    __slots__ = ("uris", "names")
+
+    def __init__(
+        self, uris: list[str] | None = None, names: list[str | None] | None = None
+    ):
+        self.uris: list[str] = uris if uris is not None else []
+        self.names: list[str | None] = names if names is not None else []
+
+    def __len__(self) -> int:
+        return len(self.uris)
+
+    def __getitem__(self, index: slice) -> "Selection":
+        return Selection(self.uris[index], self.names[index])
+
+    def append(self, uri: str, name: str | None = None):
+        self.uris.append(uri)
+        self.names.append(name)
+
+    def extend(self, other: "Selection"):
+        self.uris += other.uris
+        self.names += other.names
+
+    def shuffle(self):
+        order = list(range(len(self.uris)))
+        random.shuffle(order)
+        self.uris = [self.uris[i] for i in order]
+        self.names = [self.names[i] for i in order]
+
+    def reverse(self):
+        self.uris.reverse()
+        self.names.reverse()
+
+    def move_to_end(self, uris: set[str]):
+        order = [i for i, uri in enumerate(self.uris) if uri not in uris]
+        order += [i for i, uri in enumerate(self.uris) if uri in uris]
+        self.uris = [self.uris[i] for i in order]
+        self.names = [self.names[i] for i in order]
+
+    def resolve_names(self, client: spotifython.Client) -> list[str]:
+        # only create elements for items selected without their name
+        for i, name in enumerate(self.names):
+            if name is None:
+                self.names[i] = client.get_element(spotifython.URI(self.uris[i])).name
+        return self.names
+
+
+# binary layout: magic, selectors, (source uri, version) pairs, (uri, name) pairs
+_SNAPSHOT_MAGIC = b"SPSN\x01"
+_SNAPSHOT_URI_TYPES = ("track", "episode")
+
+
+def _pack_str(value: str) -> bytes:
+    data = value.encode("utf-8")
+    return struct.pack("<H", len(data)) + data
+
+
+def _unpack_str(data: bytes, offset: int) -> tuple[str, int]:
+    (length,) = struct.unpack_from("<H", data, offset)
+    (value,) = struct.unpack_from(f"<{length}s", data, offset + 2)
+    return str(value, encoding="utf-8"), offset + 2 + length
+
+
+def write_snapshot(
+    path: str, selectors: list[str], sources: dict[str, str], selection: Selection
+):
+    data = bytearray(_SNAPSHOT_MAGIC + struct.pack("<H", len(selectors)))
+    for selector in selectors:
+        data += _pack_str(selector)
+    data += struct.pack("<H", len(sources))
+    for uri, version in sources.items():
+        data += _pack_str(uri) + _pack_str(version)
+    data += struct.pack("<I", len(selection))
+    for uri, name in zip(selection.uris, selection.names):
+        # known types are stored as a type index and the bare id
+        _, uri_type, uri_id = (uri.split(":", 2) + ["", ""])[:3]
+        if uri_type in _SNAPSHOT_URI_TYPES and ":" not in uri_id:
+            data += struct.pack("<B", _SNAPSHOT_URI_TYPES.index(uri_type) + 1)
+            data += _pack_str(uri_id)
+        else:
+            data += struct.pack("<B", 0)
+            data += _pack_str(uri)
+        data += _pack_str(name or "")
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as out_file:
+        out_file.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def read_snapshot(path: str) -> tuple[list[str], dict[str, str], Selection]:
+    with open(path, "rb") as in_file:
+        data = in_file.read()
+    if not data.startswith(_SNAPSHOT_MAGIC):
+        raise ValueError(f"{path} is not a snapshot")
+    offset = len(_SNAPSHOT_MAGIC)
+
+    try:
+        (count,) = struct.unpack_from("<H", data, offset)
+        offset += 2
+        selectors = []
+        for _ in range(count):
+            selector, offset = _unpack_str(data, offset)
+            selectors.append(selector)
+
+        (count,) = struct.unpack_from("<H", data, offset)
+        offset += 2
+        sources = {}
+        for _ in range(count):
+            uri, offset = _unpack_str(data, offset)
+            sources[uri], offset = _unpack_str(data, offset)
+
+        (count,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        selection = Selection()
+        for _ in range(count):
+            (type_index,) = struct.unpack_from("<B", data, offset)
+            value, offset = _unpack_str(data, offset + 1)
+            if type_index != 0:
+                value = f"spotify:{_SNAPSHOT_URI_TYPES[type_index - 1]}:{value}"
+            name, offset = _unpack_str(data, offset)
+            selection.append(value, name or None)
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f"{path} is not a valid snapshot") from e
+    return selectors, sources, selection
+
+
+def collection_version(elem: spotifython.PlayContext) -> str | None:
+    # albums are immutable and do not need to be tracked
+    if isinstance(elem, spotifython.Playlist):
+        return elem.snapshot_id
+    if isinstance(elem, spotifython.SavedTracks):
+        items = elem.items
+        return f"{len(items)}:{items[0].uri if len(items) > 0 else ''}"
+    return None
+
+
+# binary layout: magic, mtime of the cached collection, item names separated by null
+# bytes; spotifython requests a cached collection again after a week
+_NAME_INDEX_MAGIC = b"SPNI\x01"
+_NAME_INDEX_MAX_AGE = 3600 * 24 * 7
+
+
+def _mtime(path: str) -> int:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def write_name_index(path: str, source_mtime: int, names: list[str]):
+    data = _NAME_INDEX_MAGIC + struct.pack("<q", source_mtime)
+    data += "\0".join(name.replace("\0", "") for name in names).encode("utf-8")
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as out_file:
+        out_file.write(data)
+    os.replace(path + ".tmp", path)
+
+
+def read_name_index(path: str, source_mtime: int) -> list[str] | None:
+    # None if the index is missing or was built from other collection data
+    try:
+        with open(path, "rb") as in_file:
+            data = in_file.read()
+    except FileNotFoundError:
+        return None
+    offset = len(_NAME_INDEX_MAGIC) + 8
+    if (
+        not data.startswith(_NAME_INDEX_MAGIC)
+        or len(data) < offset
+        or struct.unpack_from("<q", data, len(_NAME_INDEX_MAGIC))[0] != source_mtime
+    ):
+        return None
+    try:
+        text = str(data[offset:], encoding="utf-8")
+    except UnicodeDecodeError:
+        return None
+    return text.split("\0") if text != "" else []
+
+
+def selector_needs_input(selector: str) -> bool:
+    # mirrors the defaults of UriType.convert
+    terms = re.split(r"(?<!(?<!\\)\\)@", selector)
+    if "#ask" in terms or terms[0] == "search":
+        return True
+    if terms[0] == "saved":
+        return len(terms) < 3
+    if terms[0] == "snap":
+        return False
+    # a collection uri without item selector defaults to "#ask"
+    uri_type = (terms[0].split(":") + ["", ""])[1]
+    return uri_type not in ("track", "episode") and len(terms) < 2
+
+
+class TimeType(click.ParamType):
+    # relative ("90m", "12h", "7d", "2w", "1y") or absolute (iso format) point in time
+    name = "time"
+    _UNITS = {"m": 60, "h": 3600, "d": 86400, "w": 86400 * 7, "y": 86400 * 365}
+
+    def convert(self, value: str | float, param, ctx) -> float:
+        if isinstance(value, float):
+            return value
+        if (match := re.fullmatch(r"(\d+)([mhdwy])", value)) is not None:
+            return time.time() - int(match[1]) * self._UNITS[match[2]]
+        import datetime
+
+        try:
+            return datetime.datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            self.fail(
+                f"'{value}' is neither a duration like 7d nor a date like 2023-01-31",
+                param,
+                ctx,
+            )
+
+
+class History:
+    # plays are only ever appended; names are stored once per track and artist
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tracks (id INTEGER PRIMARY KEY, uri TEXT UNIQUE NOT NULL, name TEXT);
+        CREATE TABLE IF NOT EXISTS artists (id INTEGER PRIMARY KEY, uri TEXT UNIQUE NOT NULL, name TEXT);
+        CREATE TABLE IF NOT EXISTS plays (time REAL NOT NULL, track INTEGER NOT NULL, artist INTEGER);
+        CREATE INDEX IF NOT EXISTS plays_time ON plays (time);
+        CREATE INDEX IF NOT EXISTS plays_track ON plays (track, time);
+        CREATE INDEX IF NOT EXISTS plays_artist ON plays (artist, time);
+        CREATE TABLE IF NOT EXISTS play_artists (play INTEGER NOT NULL, artist INTEGER NOT NULL, time REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS play_artists_artist ON play_artists (artist, time);
+        CREATE INDEX IF NOT EXISTS play_artists_play ON play_artists (play);
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path)
+        migrate = (
+            self._db.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'plays'"
+            ).fetchone()
+            is not None
+            and self._db.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'play_artists'"
+            ).fetchone()
+            is None
+        )
+        self._db.executescript(self._SCHEMA)
+        if migrate:
+            # histories recorded before play_artists only know the first artist
+            with self._db:
+                self._db.execute(
+                    "INSERT INTO play_artists SELECT rowid, artist, time FROM plays"
+                )
+
+    def close(self):
+        self._db.close()
+
+    def _get_id(self, table: str, uri: str, name: str) -> int:
+        self._db.execute(
+            f"INSERT INTO {table} (uri, name) VALUES (?, ?) "
+            "ON CONFLICT (uri) DO UPDATE SET name = excluded.name",
+            (uri, name),
+        )
+        return self._db.execute(
+            f"SELECT id FROM {table} WHERE uri = ?", (uri,)
+        ).fetchone()[0]
+
+    def record(
+        self,
+        timestamp: float,
+        track_uri: str,
+        track_name: str,
+        artists: list[tuple[str, str]],
+        duration: float | None = None,
+    ) -> bool:
+        with self._db:
+            track = self._get_id("tracks", track_uri, track_name)
+            artist_ids = [self._get_id("artists", uri, name) for uri, name in artists]
+            # polling and hooks may report the same play more than once; it is the
+            # last recorded play and started less than the track duration before
+            last = self._db.execute(
+                "SELECT track, time FROM plays ORDER BY time DESC LIMIT 1"
+            ).fetchone()
+            if (
+                last is not None
+                and last[0] == track
+                and abs(timestamp - last[1]) < (duration or 30)
+            ):
+                return False
+            # plays.artist is the main artist (if any), play_artists holds all of them
+            play = self._db.execute(
+                "INSERT INTO plays (time, track, artist) VALUES (?, ?, ?)",
+                (timestamp, track, artist_ids[0] if len(artist_ids) > 0 else None),
+            ).lastrowid
+            self._db.executemany(
+                "INSERT INTO play_artists (play, artist, time) VALUES (?, ?, ?)",
+                [(play, artist, timestamp) for artist in artist_ids],
+            )
+        return True
+
+    def top(
+        self, since: float, by_artist: bool, limit: int
+    ) -> list[tuple[str, str, int]]:
+        table, column, source = (
+            ("artists", "artist", "play_artists")
+            if by_artist
+            else ("tracks", "track", "plays")
+        )
+        return self._db.execute(
+            f"SELECT t.uri, t.name, p.count FROM ("
+            f"SELECT {column} AS id, COUNT(*) AS count FROM {source} WHERE time >= ? "
+            f"GROUP BY {column} ORDER BY count DESC LIMIT ?"
+            f") AS p JOIN {table} AS t ON t.id = p.id ORDER BY p.count DESC",
+            (since, limit),
+        ).fetchall()
+
+    def since(self, since: float) -> list[tuple[float, str, str, str | None]]:
+        return self._db.execute(
+            "SELECT p.time, t.uri, t.name, a.name FROM plays AS p "
+            "JOIN tracks AS t ON t.id = p.track LEFT JOIN artists AS a ON a.id = p.artist "
+            "WHERE p.time >= ? ORDER BY p.time",
+            (since,),
+        ).fetchall()
+
+    def count(self, since: float, uri: str | None = None) -> int:
+        if uri is None:
+            query = "SELECT COUNT(*) FROM plays WHERE time >= ?"
+            params: tuple = (since,)
+        else:
+            column, table, source = (
+                ("artist", "artists", "play_artists")
+                if ":artist:" in uri
+                else ("track", "tracks", "plays")
+            )
+            query = (
+                f"SELECT COUNT(*) FROM {source} WHERE {column} = "
+                f"(SELECT id FROM {table} WHERE uri = ?) AND time >= ?"
+            )
+            params = (uri, since)
+        return self._db.execute(query, params).fetchone()[0]
+
+    def recent_tracks(self, since: float) -> set[str]:
+        return {
+            row[0]
+            for row in self._db.execute(
+                "SELECT DISTINCT t.uri FROM plays AS p JOIN tracks AS t "
+                "ON t.id = p.track WHERE p.time >= ?",
+                (since,),
+            )
+        }
+
+
 class MutuallyExclusiveOption(click.Option):
     def __init__(self, *args, **kwargs):
         self.mutually_exclusive = set(kwargs.pop("mutually_exclusive", []))
@@ -95,30 +569,193 @@ class QuietChoice(click.Choice):
         return param.human_readable_name
 
 
+def _fuzzy_score(term: str, name: str) -> int | None:
+    # number of skipped characters between the first and last matched one
+    pos = name.find(term[0])
+    if pos == -1:
+        return None
+    start = pos
+    for char in term[1:]:
+        pos = name.find(char, pos + 1)
+        if pos == -1:
+            return None
+    return pos - start + 1 - len(term)
+
+
+def rank_names(names: Sequence[str], term: str, limit: int) -> list[str]:
+    # ranks: 0 prefix, 1 case-insensitive prefix, 2 substring, 3 fuzzy (subsequence)
+    if term == "":
+        return list(names[:limit])
+
+    key = term.casefold()
+    folded = [name.casefold() for name in names]
+    ranked: dict[int, tuple[int, int]] = {}
+    for i, name in enumerate(folded):
+        pos = name.find(key)
+        if pos == 0:
+            ranked[i] = (0 if names[i].startswith(term) else 1, 0)
+        elif pos > 0:
+            ranked[i] = (2, pos)
+
+    if len(ranked) < limit:
+        for i, name in enumerate(folded):
+            if i in ranked:
+                continue
+            score = _fuzzy_score(key, name)
+            if score is not None:
+                ranked[i] = (3, score)
+
+    # ties are broken by the name so a filtered candidate list ranks the same
+    best = heapq.nsmallest(
+        limit, ranked.items(), key=lambda e: (e[1], len(names[e[0]]), names[e[0]])
+    )
+    return [names[i] for i, _ in best]
+
+
+class CompletionMemo:
+    # results of recent completions; a longer input whose new part only narrows
+    # down a list of names is answered by filtering the list for a shorter one
+    MAX_CANDIDATES = 256
+    _MAX_ENTRIES = 8
+    _MAX_AGE = 600
+    _SPLIT = re.compile(r"(?<!(?<!\\)\\)@")
+
+    def __init__(self, cache_dir: str, config: str):
+        # accounts with different configs see different libraries
+        self._config: str = os.path.abspath(config)
+        runtime_dir = os.getenv("XDG_RUNTIME_DIR")
+        self._path: str = (
+            os.path.join(runtime_dir, "spotifython-cli", "completion.json")
+            if runtime_dir
+            else os.path.join(cache_dir, "completion.json")
+        )
+        # changes whenever spotifython or a snapshot refreshes library data
+        self._generation: list[int] = [
+            _mtime(os.path.join(cache_dir, "me")),
+            _mtime(os.path.join(cache_dir, "saved_tracks")),
+            _mtime(os.path.join(get_data_dir(), "snapshots")),
+        ]
+
+        self._entries: list[dict] = []
+        try:
+            with open(self._path, "r") as memo_file:
+                data = json.load(memo_file)
+            if data["generation"] == self._generation:
+                self._entries = [
+                    e
+                    for e in data["entries"]
+                    if e["time"] > time.time() - self._MAX_AGE
+                ]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+
+    def _valid(self, entry: dict) -> bool:
+        # the config (e.g. completion_limit) and the cache files of the listed
+        # collection (e.g. an edited playlist) must be unchanged
+        return entry.get("config") == self._config and all(
+            _mtime(path) == mtime for path, mtime in entry.get("sources", [])
+        )
+
+    def lookup(self, incomplete: str) -> list[shell_completion.CompletionItem] | None:
+        entries = [e for e in self._entries if self._valid(e)]
+        for entry in reversed(entries):
+            if entry["key"] == incomplete:
+                return [
+                    shell_completion.CompletionItem(value, help=help)
+                    for value, help in entry["items"]
+                ]
+
+        for entry in reversed(entries):
+            if entry["base"] is None:
+                continue
+            prefix, term, names, limit = entry["base"]
+            if not incomplete.startswith(prefix + term):
+                continue
+            new_term = incomplete[len(prefix) :]
+            if len(self._SPLIT.split(new_term)) > 1:
+                continue
+            possible = rank_names(names, new_term, limit)
+            # a single saved collection is selected instead of listed
+            if len(possible) == 1 and prefix == "saved@":
+                return None
+            return [shell_completion.CompletionItem(prefix + n) for n in possible]
+        return None
+
+    def store(
+        self,
+        incomplete: str,
+        items: list[shell_completion.CompletionItem],
+        base: tuple[str, str, list[str], int] | None,
+        sources: list[str],
+    ):
+        # only a complete list for a non-empty term can be filtered later
+        if base is not None and (
+            base[1] == "" or len(base[2]) >= CompletionMemo.MAX_CANDIDATES
+        ):
+            base = None
+        self._entries.append(
+            {
+                "key": incomplete,
+                "config": self._config,
+                "sources": [(path, _mtime(path)) for path in [self._config, *sources]],
+                "time": time.time(),
+                "items": [(item.value, item.help) for item in items],
+                "base": base,
+            }
+        )
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(self._path + ".tmp", "w") as memo_file:
+                json.dump(
+                    {
+                        "generation": self._generation,
+                        "entries": self._entries[-self._MAX_ENTRIES :],
+                    },
+                    memo_file,
+                )
+            os.replace(self._path + ".tmp", self._path)
+        except OSError:
+            pass
+
+
 class UriType(click.ParamType):
     name = "spotify element uri or identifier"
 
     def convert(
-        self, value: str | tuple[spotifython.URI], param, ctx: click.Context | None
-    ) -> tuple[spotifython.URI]:
+        self, value: str | Selection, param, ctx: click.Context | None
+    ) -> Selection:
         # param is unused
         del param
 
-        if isinstance(value, tuple):
+        if isinstance(value, Selection):
             return value
 
         if ctx is not None:
             if (tmp := ctx.find_object(Context)) is not None:
                 context: Context = tmp
             else:
-                return tuple()
+                return Selection()
         else:
-            return tuple()
+            return Selection()
 
+        context.selectors.append(value)
         elements = []
 
         terms = re.split(r"(?<!(?<!\\)\\)@", value)
         match terms.pop(0):
+            case "snap":
+                if len(terms) == 0:
+                    self.fail("no snapshot specicied")
+                try:
+                    _, sources, selection = read_snapshot(
+                        context.snapshot_path(terms[0])
+                    )
+                except (FileNotFoundError, ValueError):
+                    self.fail(f"snapshot '{terms[0]}' not found")
+                # a snapshot saved from this one depends on the same collections
+                context.resolved_sources |= sources
+                context.snapshots_used.append(terms[0])
+                return selection
             case "saved":
                 if len(terms) == 0:
                     self.fail("no collection specicied")
@@ -161,7 +798,7 @@ class UriType(click.ParamType):
                             "config option `interface.dmenu_cmdline` is not configured correctly"
                         )
                 if term == "":
-                    return tuple()
+                    return Selection()
                 results = context.client.search(
                     term, "track,album,playlist,episode,show", limit=10
                 )
@@ -186,40 +823,72 @@ class UriType(click.ParamType):
                     self.fail(str(e))
 
         logging.debug(f"selecting from: {elements}")
-        ret = []
+        ret = Selection()
         for elem in elements:
             if isinstance(elem, spotifython.Playable):
-                ret.append(elem)
+                # the name is resolved later if needed
+                ret.append(str(elem.uri))
                 continue
 
             assert isinstance(elem, spotifython.PlayContext)
+            if (version := collection_version(elem)) is not None:
+                context.resolved_sources[str(elem.uri)] = version
             if len(terms) == 0:
                 terms = ["#ask"]
 
+            items = elem.items
             if terms[0] == "#all":
-                ret += elem.items
+                for item in items:
+                    ret.append(str(item.uri), item.name)
                 continue
 
             if terms[0] == "#ask":
-                options = {item.name: item for item in elem.items}
+                options = {item.name: str(item.uri) for item in items}
                 try:
-                    ret += dmenu_select("songs: ", options, context.config)
+                    selected = dmenu_query("songs: ", list(options), context.config)
                 except FileNotFoundError:
                     self.fail(
                         "config option `interface.dmenu_cmdline` is not configured correctly"
                     )
-            ret += [item for item in elem.items if item.name.startswith(terms[0])]
-        logging.debug(f"selected: {ret}")
-        return tuple(elem.uri for elem in ret)
+                for name in selected:
+                    if name in options:
+                        ret.append(options[name], name)
+            for item in items:
+                if item.name.startswith(terms[0]):
+                    ret.append(str(item.uri), item.name)
+        logging.debug(f"selected {len(ret)} items")
+        return ret
 
     def complete_initial(
         self,
-        client: spotifython.Client,
+        context: "Context",
         terms: list[str],
     ) -> (
         list[shell_completion.CompletionItem] | tuple[str, spotifython.Cacheable | None]
     ):
+        client = context.client
+        limit = context.completion_limit
         match terms[0][:2]:
+            case "sn":  # snapshot
+                if len(terms) < 2:
+                    return [
+                        shell_completion.CompletionItem("snap@"),
+                        shell_completion.CompletionItem("snap@_"),
+                    ]
+                try:
+                    names = sorted(
+                        name
+                        for name in os.listdir(context.snapshot_dir)
+                        if not name.endswith(".tmp")
+                    )
+                except FileNotFoundError:
+                    names = []
+                candidates = rank_names(names, terms[1], CompletionMemo.MAX_CANDIDATES)
+                context.completion_base = ("snap@", terms[1], candidates, limit)
+                return [
+                    shell_completion.CompletionItem(f"snap@{name}")
+                    for name in candidates[:limit]
+                ]
             case "sp":  # spotify uri
                 uri_types = ["album", "playlist", "show", "track", "episode"]
                 uri_elems = terms[0].split(":")
@@ -234,7 +903,9 @@ class UriType(click.ParamType):
                     try:
                         uri = spotifython.URI(terms.pop(0))
                         elem = client.get_element(uri)
-                        elem.name
+                        # a cached collection exists and is not loaded for its names
+                        if not os.path.exists(context.collection_cache_path(elem)):
+                            elem.name
                         return (prefix, elem)
                     except:
                         return []
@@ -294,22 +965,35 @@ class UriType(click.ParamType):
                         .replace("@", "\\@"): album
                         for album in client.saved_albums
                     }
-                    ret = [o for o in options.keys() if o.startswith(terms[1])]
-                    if terms[1] in ret and len(terms) > 2:
+                    if terms[1] in options and len(terms) > 2:
                         ret = [terms[1]]
+                    else:
+                        candidates = rank_names(
+                            list(options.keys()),
+                            terms[1],
+                            CompletionMemo.MAX_CANDIDATES,
+                        )
+                        context.completion_base = (
+                            "saved@",
+                            terms[1],
+                            candidates,
+                            limit,
+                        )
+                        ret = candidates[:limit]
                     if len(ret) == 1:
                         terms.pop(0)
                         terms.pop(0)
                         return (f"saved@{ret[0]}", options[ret[0]])
                     else:
-                        if len(ret) == 0 or terms[1] == "":
-                            ret = list(options.keys()) + ["#saved tracks"]
+                        if terms[1] == "":
+                            ret = ["#saved tracks"] + ret
                         return [
                             shell_completion.CompletionItem(f"saved@{e}") for e in ret
                         ]
         return [
             shell_completion.CompletionItem("saved@", help="saved collections"),
             shell_completion.CompletionItem("search@", help="spotify general search"),
+            shell_completion.CompletionItem("snap@", help="saved selections"),
             shell_completion.CompletionItem("spotify\\:", help="spotify uri"),
         ]
 
@@ -319,14 +1003,26 @@ class UriType(click.ParamType):
         # param is unused
         del param
 
-        context = Context(ctx.find_root().params)
-        client = context.client
-        terms = re.split(r"(?<!(?<!\\)\\)@", incomplete)
+        memo = CompletionMemo(get_cache_dir(), ctx.find_root().params["config"])
+        if (items := memo.lookup(incomplete)) is not None:
+            return items
 
+        context = Context(ctx.find_root().params)
         try:
-            ret = self.complete_initial(client, terms)
+            items = self.complete(context, incomplete)
         except:
             return []
+        memo.store(
+            incomplete, items, context.completion_base, context.completion_sources
+        )
+        return items
+
+    def complete(
+        self, context: "Context", incomplete: str
+    ) -> list[shell_completion.CompletionItem]:
+        terms = re.split(r"(?<!(?<!\\)\\)@", incomplete)
+
+        ret = self.complete_initial(context, terms)
         if isinstance(ret, list):
             return ret
 
@@ -360,12 +1056,22 @@ class UriType(click.ParamType):
             ]
 
         assert isinstance(elem, spotifython.PlayContext)
+        context.completion_sources.append(context.collection_cache_path(elem))
 
-        options = [item.name for item in elem.items] + ["#ask", "#all"]
-
-        possible = [opt for opt in options if opt.startswith(terms[0])]
-        if len(possible) == 0:
-            possible = options
+        candidates = rank_names(
+            context.item_names(elem),
+            terms[0],
+            CompletionMemo.MAX_CANDIDATES,
+        )
+        context.completion_base = (
+            prefix + "@",
+            terms[0],
+            candidates,
+            context.completion_limit,
+        )
+        possible = candidates[: context.completion_limit]
+        if terms[0] == "":
+            possible = ["#ask", "#all"] + possible
 
         return [shell_completion.CompletionItem(prefix + "@" + opt) for opt in possible]
 
@@ -376,13 +1082,17 @@ class Context:
         self.config: configparser.ConfigParser = configparser.ConfigParser()
         self.config.read(cli_params["config"])
 
-        self._cache_dir: str = os.path.join(
-            os.getenv(
-                "XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")
-            ),
-            "spotifython-cli",
-        )
+        self._cache_dir: str = get_cache_dir()
         self._auth = load_authentication(cache_dir=self._cache_dir, config=self.config)
+        # spotifython refreshes an expired token after the first api request failed
+        if (
+            isinstance(
+                prewarmed := getattr(spotifython.connection, "requests", None),
+                PrewarmedRequests,
+            )
+            and self._auth.token_expires < time.time()
+        ):
+            prewarmed.connect(ACCOUNTS_URL)
         self.client: spotifython.Client = spotifython.Client(
             cache_dir=self._cache_dir,
             authentication=self._auth,
@@ -394,15 +1104,68 @@ class Context:
             else None
         )
 
+        self.completion_limit: int = (
+            self.config["interface"].getint("completion_limit", 50)
+            if "interface" in self.config
+            else 50
+        )
+
+        # filled by UriType.convert for saving and refreshing snapshots
+        self.selectors: list[str] = []
+        self.resolved_sources: dict[str, str] = {}
+        self.snapshots_used: list[str] = []
+
+        # filled by UriType.complete if the completion is a filterable list of names
+        self.completion_base: tuple[str, str, list[str], int] | None = None
+        self.completion_sources: list[str] = []
+
+    @property
+    def history_path(self) -> str:
+        return os.path.join(get_data_dir(), "history.db")
+
+    @property
+    def snapshot_dir(self) -> str:
+        return os.path.join(get_data_dir(), "snapshots")
+
+    def collection_cache_path(self, elem: spotifython.Cacheable) -> str:
+        # the file spotifython caches the element in
+        if isinstance(elem, spotifython.SavedTracks):
+            return os.path.join(self._cache_dir, "saved_tracks")
+        return os.path.join(self._cache_dir, str(elem.uri))
+
+    def item_names(self, elem: spotifython.PlayContext) -> list[str]:
+        # names from the index of the cached collection to not create every item
+        source = self.collection_cache_path(elem)
+        index = os.path.join(self._cache_dir, "names", os.path.basename(source))
+        mtime = _mtime(source)
+        if mtime != 0 and time.time() - mtime / 1e9 < _NAME_INDEX_MAX_AGE:
+            if (names := read_name_index(index, mtime)) is not None:
+                return names
+
+        names = [item.name for item in elem.items]
+        # loading may have requested the collection again
+        if (mtime := _mtime(source)) != 0:
+            try:
+                write_name_index(index, mtime, names)
+            except OSError:
+                pass
+        return names
+
+    def snapshot_path(self, name: str) -> str:
+        if name == "" or "/" in name or name.startswith("."):
+            raise ValueError(f"invalid snapshot name '{name}'")
+        return os.path.join(self.snapshot_dir, name)
+
     def __del__(self):
         # cache authentication data
         if self._auth is None:
             return
+        # other processes (e.g. refreshing snapshots) may read or write it at once
+        path = os.path.join(self._cache_dir, "authentication")
         try:
-            with open(
-                os.path.join(self._cache_dir, "authentication"), "w"
-            ) as auth_file:
+            with open(f"{path}.{os.getpid()}.tmp", "w") as auth_file:
                 json.dump(self._auth.to_dict(), auth_file)
+            os.replace(f"{path}.{os.getpid()}.tmp", path)
         except:
             pass
 
@@ -448,6 +1211,14 @@ def cli(ctx, verbose: int, device_id: str, config: str):
 @click.option(
     "--to-ask", is_flag=True, help="query using dmenu until which track to play"
 )
+@click.option(
+    "--save-as", metavar="NAME", help="save the selection as snapshot `snap@NAME`"
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="update used snapshots in the background if their source collections changed",
+)
 @click.argument("elements", nargs=-1, type=UriType())
 @click.pass_context
 def play(
@@ -457,16 +1228,20 @@ def play(
     queue: bool,
     from_ask: bool,
     to_ask: bool,
-    elements: tuple[tuple[spotifython.URI]],
+    save_as: str | None,
+    refresh: bool,
+    elements: tuple[Selection],
 ):
     """
     start playback
 
 
-    Elements begin with either a spotify uri or the literal string "search" or "saved". Specifiers are seperated by an '@'.
+    Elements begin with either a spotify uri or the literal string "search", "saved" or "snap". Specifiers are seperated by an '@'.
 
     After "saved" must be the name of a saved playlist, saved album or "#saved tracks".
 
+    After "snap" must be the name of a selection saved with `--save-as`. It is played without resolving it again.
+
     After "search" must be the search term. The search results will be displayed using the config value `interface.dmenu_cmdline`. If that is not specicied, the first song will be used.
 
     After a collection is selected, the next literal will select the track.
@@ -490,36 +1265,72 @@ def play(
         except IndexError:
             device_id = None
 
-    uris = [uri for uri_list in elements for uri in uri_list]
+    selection = Selection()
+    for element in elements:
+        selection.extend(element)
+
+    if save_as is not None:
+        try:
+            path = ctx.snapshot_path(save_as)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--save-as")
+        write_snapshot(path, ctx.selectors, ctx.resolved_sources, selection)
+
+    if refresh and len(ctx.snapshots_used) > 0:
+        import subprocess
+
+        for name in ctx.snapshots_used:
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "spotifython_cli",
+                    "--config",
+                    context.find_root().params["config"],
+                    "refresh-snapshot",
+                    name,
+                ],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
 
     if shuffle:
-        random.shuffle(uris)
+        selection.shuffle()
+        avoid_hours = (
+            ctx.config["history"].getfloat("shuffle_avoid_hours", 0)
+            if "history" in ctx.config
+            else 0
+        )
+        if avoid_hours > 0 and os.path.exists(ctx.history_path):
+            history = History(ctx.history_path)
+            selection.move_to_end(
+                history.recent_tracks(time.time() - avoid_hours * 3600)
+            )
+            history.close()
     elif reverse:
-        uris.reverse()
+        selection.reverse()
 
     if from_ask:
-        options = {ctx.client.get_element(uri).name: uri for uri in uris}
-        first = dmenu_query("first:", list(options.keys()), ctx.config)
-        if len(first) > 0 and first[0] in options:
-            while uris[0] != options[first[0]]:
-                uris.pop(0)
+        names = selection.resolve_names(ctx.client)
+        first = dmenu_query("first:", list(dict.fromkeys(names)), ctx.config)
+        if len(first) > 0 and first[0] in names:
+            selection = selection[names.index(first[0]) :]
 
     if to_ask:
-        uris.reverse()
-        options = {ctx.client.get_element(uri).name: uri for uri in uris}
-        last = dmenu_query("last:", list(options.keys()), ctx.config)
-        if len(last) > 0 and last[0] in options:
-            while uris[0] != options[last[0]]:
-                uris.pop(0)
-        uris.reverse()
+        names = selection.resolve_names(ctx.client)
+        last = dmenu_query("last:", list(dict.fromkeys(reversed(names))), ctx.config)
+        if len(last) > 0 and last[0] in names:
+            selection = selection[: len(names) - names[::-1].index(last[0])]
 
     if queue:
-        for uri in uris[:50]:
-            ctx.client.add_to_queue(uri, device_id=device_id)
+        for uri in selection.uris[:50]:
+            ctx.client.add_to_queue(spotifython.URI(uri), device_id=device_id)
         return
 
     # spotify api can't handle more elements
-    uris = uris[:700]
+    uris = selection.uris[:700]
 
     if len(uris) == 0:
         uris = None
@@ -533,6 +1344,81 @@ def play(
             ctx.client.play(uris, device_id=device_id)
 
 
+def update_snapshot(
+    context: click.Context, ctx: "Context", name: str, seen: set[str]
+) -> bool:
+    # snapshots this one was saved from are updated first; returns whether it changed
+    from spotifython.connection import Connection
+
+    seen.add(name)
+    path = ctx.snapshot_path(name)
+    selectors, sources, _ = read_snapshot(path)
+    if any(selector_needs_input(s) for s in selectors):
+        logging.info(f"snapshot '{name}' depends on user input and can't be refreshed")
+        return False
+
+    changed = False
+    for selector in selectors:
+        terms = re.split(r"(?<!(?<!\\)\\)@", selector)
+        if terms[0] == "snap" and len(terms) > 1 and terms[1] not in seen:
+            changed |= update_snapshot(context, ctx, terms[1], seen)
+
+    # only request the version of every source instead of the full collection
+    connection = Connection(authentication=ctx._auth)
+    for uri, version in sources.items():
+        elem_uri = spotifython.URI(uri)
+        if elem_uri.type is spotifython.Playlist:
+            data = connection.make_request(
+                "GET", f"playlists/{elem_uri.id}?fields=snapshot_id"
+            )
+            current = data["snapshot_id"] if data is not None else version
+            if current != version:
+                # make the cached playlist outdated
+                ctx.client.get_playlist(elem_uri, snapshot_id=current)
+                changed = True
+        elif elem_uri.type is spotifython.SavedTracks:
+            data = connection.make_request(
+                "GET", "me/tracks?limit=1&fields=total,items(track(uri))"
+            )
+            if data is None:
+                continue
+            first = data["items"][0]["track"]["uri"] if data["total"] > 0 else ""
+            if f"{data['total']}:{first}" != version:
+                try:
+                    os.remove(os.path.join(ctx._cache_dir, "saved_tracks"))
+                except FileNotFoundError:
+                    pass
+                changed = True
+
+    if not changed:
+        logging.info(f"snapshot '{name}' is up to date")
+        return False
+
+    ctx.resolved_sources = {}
+    uri_type = UriType()
+    selection = Selection()
+    for selector in selectors:
+        selection.extend(uri_type.convert(selector, None, context))
+    write_snapshot(path, selectors, ctx.resolved_sources, selection)
+    logging.info(f"refreshed snapshot '{name}'")
+    return True
+
+
+@cli.command("refresh-snapshot", hidden=True)
+@click.argument("name")
+@click.pass_context
+def refresh_snapshot(context: click.Context, name: str):
+    """
+    resolve a snapshot again if its source collections changed
+    """
+    if (tmp := context.find_object(Context)) is not None:
+        ctx: Context = tmp
+    else:
+        raise Exception("code structure invalid")
+
+    update_snapshot(context, ctx, name, set())
+
+
 @cli.command("pause")
 @click.pass_context
 def pause(context: click.Context):
@@ -641,6 +1527,130 @@ def device(context: click.Context, device_id: str):
     ctx.client.transfer_playback(device_id, True)
 
 
+@cli.group("history")
+def history():
+    """
+    record and query the local listening history
+    """
+
+
+@history.command("record")
+@click.pass_context
+def history_record(context: click.Context):
+    """
+    record the currently playing track
+
+    Use this as `on_song_change_hook` of spotifyd or call it periodically. Events passed by spotifyd other than "start" and "change" are ignored.
+    """
+    if (tmp := context.find_object(Context)) is not None:
+        ctx: Context = tmp
+    else:
+        raise Exception("code structure invalid")
+
+    event = os.getenv("PLAYER_EVENT")
+    if event is not None and event not in ("start", "change"):
+        return
+
+    if event is not None and os.getenv("TRACK_ID"):
+        item = ctx.client.get_track(f"spotify:track:{os.getenv('TRACK_ID')}")
+        started = time.time() - int(os.getenv("POSITION_MS") or 0) / 1000
+        duration = int(os.getenv("DURATION_MS") or 0) / 1000 or None
+    else:
+        from spotifython.connection import Connection
+
+        # spotifython.Client.get_playing drops the duration of the track
+        data = Connection(authentication=ctx._auth).make_request(
+            "GET", "me/player/currently-playing"
+        )
+        # a paused track would be recorded again once its estimated start moved
+        if data is None or data["item"] is None or not data["is_playing"]:
+            return
+        item = ctx.client.get_element_from_data(data["item"])
+        started = time.time() - (data.get("progress_ms") or 0) / 1000
+        duration = (data["item"].get("duration_ms") or 0) / 1000 or None
+
+    if not isinstance(item, spotifython.Track):
+        return
+
+    artists = [(str(artist.uri), artist.name) for artist in item.artists]
+    history = History(ctx.history_path)
+    if history.record(started, str(item.uri), item.name, artists, duration):
+        logging.info(f"recorded {item.name}")
+    history.close()
+
+
+@history.command("top")
+@click.option(
+    "--since",
+    type=TimeType(),
+    default="4w",
+    help="point in time like 7d, 12h or 2023-01-31",
+)
+@click.option("-a", "--artists", is_flag=True, help="rank artists instead of tracks")
+@click.option("-n", "--limit", default=10, help="number of entries")
+@click.pass_context
+def history_top(context: click.Context, since: float, artists: bool, limit: int):
+    """
+    show the most played tracks or artists
+
+    Plays count for every artist of a track.
+    """
+    if (tmp := context.find_object(Context)) is not None:
+        ctx: Context = tmp
+    else:
+        raise Exception("code structure invalid")
+
+    history = History(ctx.history_path)
+    for uri, name, count in history.top(since, artists, limit):
+        print(f"{count:>6}  {name}  ({uri})")
+    history.close()
+
+
+@history.command("since")
+@click.argument("since", type=TimeType())
+@click.pass_context
+def history_since(context: click.Context, since: float):
+    """
+    list all plays since a point in time like 7d, 12h or 2023-01-31
+    """
+    if (tmp := context.find_object(Context)) is not None:
+        ctx: Context = tmp
+    else:
+        raise Exception("code structure invalid")
+
+    history = History(ctx.history_path)
+    for timestamp, uri, name, artist_name in history.since(since):
+        if artist_name is not None:
+            name = f"{name} - {artist_name}"
+        print(
+            f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))}  {name}  ({uri})"
+        )
+    history.close()
+
+
+@history.command("count")
+@click.option(
+    "--since",
+    type=TimeType(),
+    default="1970-01-01",
+    help="point in time like 7d, 12h or 2023-01-31",
+)
+@click.argument("uri", required=False)
+@click.pass_context
+def history_count(context: click.Context, since: float, uri: str | None):
+    """
+    count plays of all tracks or of the track or artist with the given uri
+    """
+    if (tmp := context.find_object(Context)) is not None:
+        ctx: Context = tmp
+    else:
+        raise Exception("code structure invalid")
+
+    history = History(ctx.history_path)
+    print(history.count(since, uri))
+    history.close()
+
+
 @cli.command("metadata")
 @click.option(
     "--format",
@@ -740,3 +1750,27 @@ def metadata(
         return
     for key, value in print_data.items():
         print(f"{(key + ': '):<24}{str(value)}")
+
+
+def main():
+    # connect to the api while the config and authentication are loaded
+    command = invoked_command(sys.argv[1:])
+    if "_SPOTIFYTHON_CLI_COMPLETE" not in os.environ and any(
+        command[: len(c)] == c for c in API_COMMANDS
+    ):
+        # spotifython sends every request through the module global
+        # `spotifython.connection.requests`; replacing it is the only way in
+        if getattr(spotifython.connection, "requests", None) is requests:
+            prewarmed = PrewarmedRequests()
+            prewarmed.connect(API_URL)
+            spotifython.connection.requests = prewarmed
+        else:
+            logging.warning(
+                "spotifython.connection no longer uses the requests module; "
+                "the api connection is not opened in advance"
+            )
+    cli()
+
+
+if __name__ == "__main__":
+    main()